@@ -1,27 +1,90 @@
-from collections import Counter
+from itertools import cycle
+import asyncio
+import os
+import tempfile
+import time
 import traceback
 
-from datetime import datetime
 from operator import attrgetter
 
 import logging
-import json
 
-from multiprocessing import Process, Queue
+from orjson import dumps, loads
 
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from multiprocessing import Pipe, Process
+
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+from elasticsearch.serializer import JsonSerializer
 
 from osmium import SimpleHandler
 from osmium import geom
 
-geojson = geom.GeoJSONFactory()
+# Geometries are sent as WKT, more compact than GeoJSON and parsed
+# natively by geo_shape fields
+wkt = geom.WKTFactory()
+create_linestring = wkt.create_linestring
+create_multipolygon = wkt.create_multipolygon
 
-from tags import tags2dict, OSM_TAGS, INDEX_MAPPINGS
+from tags import split_tags, OSM_TAGS_SET, INDEX_MAPPINGS
 
 logger = logging.getLogger("handler")
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+# Bulk action line shared by every document, the index is passed on the request
+ACTION_HEADER = b'{"index":{}}\n'
+
+# Batches are sent as the documents joined by this separator, only the
+# first document needs its action line added
+DOCUMENT_SEPARATOR = b"\n" + ACTION_HEADER
+
+# Action lines setting the OSM type and id as document id, see --osm-ids
+ID_ACTION_HEADERS = {
+    "node": b'{"index":{"_id":"n%d"}}\n',
+    "way": b'{"index":{"_id":"w%d"}}\n',
+    "area": b'{"index":{"_id":"a%d"}}\n',
+}
+
+# Only read back what is needed to count indexed and failed documents
+BULK_FILTER_PATH = "errors,items.*.status,items.*.error"
+
+# Bulk requests can take long on a busy cluster, the client default is 10s
+BULK_TIMEOUT = 120
+
+# Index settings relaxed while loading, refreshes and fsyncs are only
+# paid once at the end with finalize_index
+BULK_LOAD_SETTINGS = {
+    "refresh_interval": "-1",
+    "translog.durability": "async",
+    "translog.flush_threshold_size": "1gb",
+}
+
+# Seconds between checks of the force merge task
+MERGE_POLL_INTERVAL = 30
+
+# Import status is logged every STATUS_MASK + 1 objects, a power of two
+# so the check is a single AND on the running total
+STATUS_MASK = 0xFFFF
+
+# Inputs above this size keep node locations in a file instead of memory
+LARGE_FILE_SIZE = 1024 ** 3
+
+# OSM object types that end up as documents, each one batched on its own
+INDEXED_TYPES = ("node", "way", "area")
+
+
+class OrjsonSerializer(JsonSerializer):
+    """
+    JSON serializer for the Elasticsearch clients backed by orjson,
+    bulk responses carry an item per document and parsing them
+    with the json module is noticeable
+    """
+
+    def json_dumps(self, data):
+        return dumps(data, default=self.default)
+
+    def json_loads(self, data):
+        return loads(data)
+
 
 def get_client(url, user, password):
     """
@@ -32,90 +95,293 @@ def get_client(url, user, password):
         - user - Elasticsearch user name
         - password - Elasticsearch password
     """
-    return Elasticsearch(url, http_auth=(user, password))
+    return Elasticsearch(
+        url, basic_auth=(user, password), serializer=OrjsonSerializer()
+    )
+
 
+def get_async_client(url, user, password, connections, retry_on_timeout):
+    """
+    Returns an asyncio Elasticsearch client tuned for bulk requests,
+    compressing the NDJSON bodies
 
-def writer_thread(worker_id, queue, es_url, es_user, es_pwd, index_name):
+    Arguments:
+        - url - Elasticsearh URL
+        - user - Elasticsearch user name
+        - password - Elasticsearch password
+        - connections - size of the connection pool
+        - retry_on_timeout - send again timed out requests, only safe when
+          documents have explicit ids as Elasticsearch usually completes the
+          original request and auto generated ids would duplicate the batch
+    """
+    return AsyncElasticsearch(
+        url,
+        basic_auth=(user, password),
+        connections_per_node=connections,
+        http_compress=True,
+        request_timeout=BULK_TIMEOUT,
+        retry_on_timeout=retry_on_timeout,
+        max_retries=3,
+        serializer=OrjsonSerializer(),
+    )
+
+
+def writer_thread(
+    worker_id, conn, es_url, es_user, es_pwd, index_name, bulk_requests, retry_on_timeout
+):
     """
     This function will run in a forked process, receiving the Elasticsearch
-    info to create the client and a reference to the Queue to get data from
+    info to create the client and the read end of its own pipe to get data from.
+    Batches arrive already serialized as NDJSON bulk bodies
+    in length prefixed messages, so there is no pickling nor a lock shared with other writers.
+    An empty message is the stop signal
     
     Arguments:
-        obj {Area} -- osmium area object
+        worker_id -- writer number, for logging
+        conn -- read end of the writer pipe
+        es_url, es_user, es_pwd -- Elasticsearch connection info
+        index_name -- destination index
+        bulk_requests -- number of bulk requests to keep in flight
+        retry_on_timeout -- send again timed out bulk requests
     """
     logger.info(f"Starting worker: {worker_id}")
-    client = get_client(es_url, es_user, es_pwd)
+    indexed_docs = asyncio.run(
+        write_batches(
+            conn, es_url, es_user, es_pwd, index_name, bulk_requests, retry_on_timeout
+        )
+    )
+    logger.info(f"Writer {worker_id} indexed {indexed_docs} documents")
+
+
+async def write_batches(
+    conn, es_url, es_user, es_pwd, index_name, bulk_requests, retry_on_timeout
+):
+    """
+    Reads batches from the pipe and sends them to Elasticsearch keeping up
+    to bulk_requests requests in flight, so the network round trips of one
+    batch overlap with the indexing of the others.
+    The pipe is not read while all the requests are busy, blocking the
+    producer until there is room for a new batch.
+
+    Returns:
+        int -- number of indexed documents
+    """
+    client = get_async_client(
+        es_url, es_user, es_pwd, bulk_requests, retry_on_timeout
+    )
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(bulk_requests)
+    in_flight = set()
     indexed_docs = 0
 
-    while True:
-        ts, job_counter, data = queue.get()
-        if ts is None:
-            logger.info(f"Writer {worker_id} indexed {indexed_docs} documents")
-            return
-        
-        indexed_docs += write_actions(client, index_name, data)
+    async def send(data):
+        nonlocal indexed_docs
+        try:
+            indexed_docs += await write_actions(client, index_name, data)
+        finally:
+            semaphore.release()
+
+    try:
+        while True:
+            await semaphore.acquire()
+            data = await loop.run_in_executor(None, conn.recv_bytes)
+            if not data:
+                break
+
+            task = asyncio.create_task(send(data))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+        await asyncio.gather(*in_flight)
+    finally:
+        await client.close()
+
+    return indexed_docs
 
 
-def write_actions(client, index_name, data):
+async def write_actions(client, index_name, data):
     """
-    Save cached objects into Elasticsearch
+    Save a serialized NDJSON batch into Elasticsearch
+
+    Arguments:
+        client -- asyncio Elasticsearch client
+        index_name -- destination index
+        data -- NDJSON bulk body, without the final newline
     """
-    #actions = list(map(lambda item: get_action(index_name, item, item["osm_id"]), data))
     try:
-        actions, errs = bulk(client=client, index=index_name, actions=data)
+        response = await client.bulk(
+            operations=data,
+            index=index_name,
+            filter_path=BULK_FILTER_PATH,
+        )
+        items = response["items"]
+
+        errs = 0
+        if response["errors"]:
+            failed = [item["index"] for item in items if "error" in item["index"]]
+            errs = len(failed)
+            logger.info(f"{errs} documents failed to index")
+            logger.debug(f"First indexing error: {failed[0]['error']}")
+
+        actions = len(items) - errs
         logger.debug(f"{actions} documents indexed")
 
-        if len(errs) > 0:
-            logger.info(f"{len(errs)} documents failed to index")
-        
-        return 0 if actions is None else actions
-    except:
-        logger.error("An exception triggered on uploading data to ES")
+        return actions
+    except Exception as e:
+        logger.error(
+            f"An exception triggered on uploading a batch of {len(data)} bytes to ES, "
+            f"its documents were not indexed: {e!r}"
+        )
         return 0
 
+
+def create_index(options):
+    """
+    Uses the import options to create a new index,
+    removing it if it already exists
+    """
+    index_name, es_url, es_user, es_pwd, es_shards = attrgetter(
+        "index_name", "es_url", "es_user", "es_pwd", "es_shards"
+    )(options)
+
+    logger.info(f"Creating index [{index_name}]...")
+
+    client = get_client(es_url, es_user, es_pwd)
+
+    if client.indices.exists(index=index_name):
+        logger.info("Index {} exists. Deleting...".format(index_name))
+        client.indices.delete(index=index_name)
+    client.indices.create(
+        index=index_name,
+        timeout="60s",
+        settings={
+            "number_of_shards": es_shards,
+            "number_of_replicas": 0,
+            **BULK_LOAD_SETTINGS,
+        },
+        mappings=INDEX_MAPPINGS,
+    )
+
+
+def finalize_index(options):
+    """
+    Restores the index settings relaxed for the bulk load,
+    merges its segments and then adds the replicas, so they copy
+    the merged segments instead of the ones about to be merged away
+    """
+    index_name, es_url, es_user, es_pwd, es_replicas = attrgetter(
+        "index_name", "es_url", "es_user", "es_pwd", "es_replicas"
+    )(options)
+
+    logger.info(f"Finalizing index [{index_name}]...")
+
+    client = get_client(es_url, es_user, es_pwd)
+
+    client.indices.put_settings(
+        index=index_name,
+        settings={
+            "refresh_interval": "1s",
+            "translog.durability": "request",
+            "translog.flush_threshold_size": None,
+        },
+    )
+
+    # Merging a large index takes long, run it as a task and poll it
+    # instead of holding a request open for the whole merge
+    task = client.indices.forcemerge(
+        index=index_name, max_num_segments=1, wait_for_completion=False
+    )["task"]
+    logger.info(f"Force merge running as task {task}")
+    while not client.tasks.get(task_id=task)["completed"]:
+        time.sleep(MERGE_POLL_INTERVAL)
+
+    client.indices.put_settings(
+        index=index_name, settings={"number_of_replicas": es_replicas}
+    )
+
+
 class OSMtoESHandler(SimpleHandler):
     def __init__(self, opts):
         SimpleHandler.__init__(self)
 
         self.options = opts
         self.db_cache_size = opts.db_cache_size
+        self.max_batch_bytes = opts.max_batch_mb * 1024 * 1024
+        self.skip_tagless_nodes = not opts.keep_tagless_nodes
+        self.skipped_nodes = 0
 
-        self.job_counter = 1
-        self.pending = []
-        self.pendingCount = 0
-
+        # With OSM ids every document carries its own action line
+        self.use_osm_ids = opts.use_osm_ids
+        if self.use_osm_ids:
+            self.batch_prefix, self.separator = b"", b"\n"
+        else:
+            self.batch_prefix, self.separator = ACTION_HEADER, DOCUMENT_SEPARATOR
 
-        self.counter = Counter(
-            {
-                "node": 0,
-                "way": 0,
-                "rel": 0,
-                "area": 0,
-            }
-        )
-
-        try:
-            self.create_index()
-        except:
-            raise ValueError("Error creating the ES index, check URL and credentials")
+        self.job_counter = 1
+        self.pending = {type: [] for type in INDEXED_TYPES}
+        self.pendingBytes = {type: 0 for type in INDEXED_TYPES}
+
+        # Documents start as a shallow copy of a per type template, cheaper
+        # than building a new dict with the same keys for every object.
+        # The promoted tags set goes along so both come from a single lookup
+        self._doc_types = {
+            type: (
+                {
+                    "osm_id": None,
+                    "osm_version": None,
+                    "osm_user": None,
+                    "visible": None,
+                    "timestamp": None,
+                    "osm_type": type,
+                    "num_tags": None,
+                    "other_tags": None,
+                },
+                OSM_TAGS_SET[type],
+            )
+            for type in INDEXED_TYPES
+        }
 
-        # Queue should contain at most 1 item, making the total number of batches in memory to be
-        # number_of_workers + one_in_query + one_being_assembled_by_main_thread
-        self.queue = Queue(1)
+        # A plain dict, Counter item updates go through Python level code
+        self.counter = {
+            "node": 0,
+            "way": 0,
+            "rel": 0,
+            "area": 0,
+        }
+        self._total = 0
 
+        # Every writer reads from its own pipe and batches are distributed round robin.
+        # Sending blocks until the writer has room for the batch, making the total number
+        # of batches in memory to be number_of_workers * bulk_requests + one_being_assembled_by_main_thread
         self.writers = []
+        self.pipes = []
 
-        index_name, es_url, es_user, es_pwd = attrgetter(
-            "index_name", "es_url", "es_user", "es_pwd"
+        index_name, es_url, es_user, es_pwd, bulk_requests, use_osm_ids = attrgetter(
+            "index_name", "es_url", "es_user", "es_pwd", "bulk_requests", "use_osm_ids"
         )(self.options)
 
         for worker_id in range(opts.worker_count):
+            reader, writer = Pipe(duplex=False)
             process = Process(
                 target=writer_thread,
-                args=(worker_id, self.queue, es_url, es_user, es_pwd, index_name),
+                # Retrying a timed out bulk only replaces documents with OSM ids
+                args=(
+                    worker_id,
+                    reader,
+                    es_url,
+                    es_user,
+                    es_pwd,
+                    index_name,
+                    bulk_requests,
+                    use_osm_ids,
+                ),
             )
             self.writers.append(process)
+            self.pipes.append(writer)
             process.start()
+            reader.close()
+
+        self.next_pipe = cycle(self.pipes)
 
     def __enter__(self):
         """
@@ -131,36 +397,12 @@ class OSMtoESHandler(SimpleHandler):
 
     def show_import_status(self):
         """
-        Show import status for every 50000 objects
+        Show import status
         """
-        if sum(self.counter.values()) % 50000 == 0:
-            logger.info(
-                "PBF data read: Nodes {node:d} | Ways {way:d} | Rel {rel:d} | Area {area:d}".format(
-                    **self.counter
-                )
+        logger.info(
+            "PBF data read: Nodes {node:d} | Ways {way:d} | Rel {rel:d} | Area {area:d}".format(
+                **self.counter
             )
-
-    def create_index(self):
-        """
-        Uses the object options to create a new index, 
-        removing it if it already exists 
-        """
-        index_name, es_url, es_user, es_pwd, es_replicas = attrgetter(
-            "index_name", "es_url", "es_user", "es_pwd", "es_replicas"
-        )(self.options)
-
-        logger.info(f"Creating index [{index_name}]...")
-
-        client = get_client(es_url, es_user, es_pwd)
-
-        if client.indices.exists(index=index_name):
-            logger.info("Index {} exists. Deleting...".format(index_name))
-            client.indices.delete(index=index_name)
-        client.indices.create(
-            index=index_name,
-            timeout="60s",
-            settings={"number_of_shards": 1, "number_of_replicas": es_replicas},
-            mappings=INDEX_MAPPINGS,
         )
 
     def process_element(self, element, geometry, type, base_db={}):
@@ -169,33 +411,50 @@ class OSMtoESHandler(SimpleHandler):
 
         Arguments:
             element -- osmium OSM oject
-            geometry -- a geometry constructed from the OSM object
+            geometry -- a WKT string constructed from the OSM object
             type -- node|way|area|rel
             based_db -- a preprocessed object to update
         """
-        element_db = {
-            "osm_id": element.id,
-            "osm_version": element.version,
-            "osm_user": element.user,
-            "visible": element.visible,
-            "timestamp": element.timestamp,
-            "osm_type": type,
-            "num_tags": len(element.tags),
-            "other_tags": tags2dict(tags=element.tags, type=type),
-        }
+        template, promoted_set = self._doc_types[type]
+
+        # Walk the TagList only once, every access crosses into osmium.
+        # Most nodes are untagged way vertices, skip the walk for those
+        tags = element.tags
+        num_tags = len(tags)
+        if num_tags:
+            promoted, other_tags = split_tags(tags, promoted_set)
+        else:
+            promoted, other_tags = None, {}
+
+        element_db = template.copy()
+        element_db["osm_id"] = element.id
+        element_db["osm_version"] = element.version
+        element_db["osm_user"] = element.user
+        element_db["visible"] = element.visible
+        # OSM timestamps have second precision, sent as epoch millis
+        element_db["timestamp"] = int(element.timestamp.timestamp()) * 1000
+        element_db["num_tags"] = num_tags
+        element_db["other_tags"] = other_tags
 
         element_db.update(base_db)
 
+        if promoted:
+            element_db.update(promoted)
+
+        doc = dumps(element_db)
+
+        # Splice the geometry as a JSON string, WKT has no characters to escape
         if geometry:
-            element_db["geometry"] = json.loads(geometry)
+            doc = doc[:-1] + b',"geometry":"' + geometry.encode("utf-8") + b'"}'
 
-        for prop in OSM_TAGS[type]:
-            if prop in element.tags:
-                element_db[prop] = element.tags[prop]
+        if self.use_osm_ids:
+            doc = ID_ACTION_HEADERS[type] % element.id + doc
 
         self.counter[type] += 1
-        self.show_import_status()
-        self.finalize_object(element_db)
+        self._total += 1
+        if not self._total & STATUS_MASK:
+            self.show_import_status()
+        self.finalize_object(doc, type)
 
     def node(self, obj):
         """
@@ -206,10 +465,21 @@ class OSMtoESHandler(SimpleHandler):
         """
         obj_type = "node"
         try:
-            if obj.visible and obj.location.valid():
-                geometry = geojson.create_point(obj)
-                base_db = {"point": [obj.location.lon, obj.location.lat]}
-                self.process_element(obj, geometry, obj_type, base_db=base_db)
+            # Untagged nodes are mostly way vertices, drop them before
+            # building anything if they are not wanted as documents
+            if self.skip_tagless_nodes and not len(obj.tags):
+                self.skipped_nodes += 1
+                return
+
+            location = obj.location
+            if obj.visible and location.valid():
+                # Points are trivial to build here, no need to go through the factory
+                lon, lat = location.lon, location.lat
+                base_db = {
+                    "point": [lon, lat],
+                    "geometry": f"POINT ({lon} {lat})",
+                }
+                self.process_element(obj, None, obj_type, base_db=base_db)
         except:
             logger.error(f"There was an error loading {obj_type} {obj.id}")
             logger.error(traceback.format_exc())
@@ -225,7 +495,7 @@ class OSMtoESHandler(SimpleHandler):
         try:
             if not obj.visible:
                 return
-            geometry = geojson.create_linestring(obj)
+            geometry = create_linestring(obj)
             self.process_element(obj, geometry, obj_type)
         except:
             logger.error(f"There was an error loading {obj_type} {obj.id}")
@@ -249,46 +519,65 @@ class OSMtoESHandler(SimpleHandler):
             if not obj.visible:
                 return
 
-            geometry = geojson.create_multipolygon(obj)
+            geometry = create_multipolygon(obj)
             self.process_element(obj, geometry, "area")
         except:
             logger.error(f"There was an error loading {obj_type} {obj.id}")
             logger.error(traceback.format_exc())
 
-    def finalize_object(self, obj):
+    def finalize_object(self, obj, type):
         """
-        Adds the object to the pending array,
-        flushing the cache if necessary
+        Adds the serialized object to the pending documents of its type,
+        flushing the cache if it reaches the maximum number of documents
+        or bytes, large polygons can make a batch huge well before the
+        document limit
 
         Arguments:
-            obj -- any osmium OSM object
+            obj -- a serialized document
+            type -- node|way|area
         """
         try:
             if obj:
-                self.pending.append(obj)
-                self.pendingCount += 1
-
-                if self.pendingCount >= self.db_cache_size:
-                    self.flush()
+                pending = self.pending[type]
+                pending.append(obj)
+                self.pendingBytes[type] += len(obj)
+
+                if (
+                    len(pending) >= self.db_cache_size
+                    or self.pendingBytes[type] >= self.max_batch_bytes
+                ):
+                    self.flush(type)
         except Exception as e:
             logger.error(f"Error finalizing object {e}")
             raise e
 
 
-    def flush(self):
+    def flush(self, type=None):
         """
-        Adds the pending documents to the instance queue
+        Sends the pending documents of a type to the next writer,
+        or all of them if no type is given.
+        Joining the batch once allocates the payload at its final size
+        instead of growing a buffer document by document
+
+        Arguments:
+            type -- node|way|area
         """
-        if self.pendingCount == 0:
+        if type is None:
+            for type in INDEXED_TYPES:
+                self.flush(type)
             return
 
-        self.queue.put(
-            (datetime.utcnow(), self.job_counter, self.pending)
-        )
+        pending = self.pending[type]
+        if not pending:
+            return
+
+        logger.debug(f"Sending {type} batch {self.job_counter}")
+        pending[0] = self.batch_prefix + pending[0]
+        next(self.next_pipe).send_bytes(self.separator.join(pending))
 
         self.job_counter += 1
-        self.pending = []
-        self.pendingCount = 0
+        pending.clear()
+        self.pendingBytes[type] = 0
 
     def run(self, input_file):
         """
@@ -299,21 +588,41 @@ class OSMtoESHandler(SimpleHandler):
         """
         logger.info(f"Importing {input_file}...")
 
+        # libosmium decodes PBF blocks in its own thread pool while the
+        # callbacks run here, the pool is sized on its first use
+        if self.options.read_threads:
+            os.environ["OSMIUM_POOL_THREADS"] = str(self.options.read_threads)
+
+        # libosmium loads whatever an existing locations file holds, so every
+        # import gets a new empty one that is removed once the file is read
         cache_system = "flex_mem"
-        self.apply_file(filename=input_file, locations=True, idx=cache_system)
+        cache_file = None
+        if os.path.getsize(input_file) > LARGE_FILE_SIZE:
+            fd, cache_file = tempfile.mkstemp(
+                prefix="osm2es-nodes-", suffix=".cache", dir=self.options.nodes_cache_dir
+            )
+            os.close(fd)
+            cache_system = f"sparse_file_array,{cache_file}"
+        logger.debug(f"Using {cache_system} node locations index")
+
+        try:
+            self.apply_file(filename=input_file, locations=True, idx=cache_system)
+        finally:
+            if cache_file:
+                os.remove(cache_file)
 
         self.flush()
 
         # Send stop signal to each worker, and wait for all to stop
-        for _ in self.writers:
+        for pipe in self.pipes:
             logger.debug(f"Stopping writer...")
-            self.queue.put((None, None, None))
-        
-        logger.debug("Closing the Queue")
-        self.queue.close()
+            pipe.send_bytes(b"")
+            pipe.close()
         
         for p in self.writers:
             p.join()
-        
+
         self.show_import_status()
+        if self.skip_tagless_nodes:
+            logger.info(f"Skipped {self.skipped_nodes} nodes without tags")
         logger.info("Done!")
@@ -1,8 +1,9 @@
 import logging
 import argparse
+import multiprocessing
 import sys
 
-from handler import OSMtoESHandler
+from handler import OSMtoESHandler, create_index, finalize_index
 
 
 logger = logging.getLogger(__name__)
@@ -15,14 +16,71 @@ def parse_fail(parser, info):
     exit(1)
 
 
+def import_files(opts, input_files):
+    """
+    Imports the files one after the other into the already created index,
+    each one with its own handler and writers
+
+    Arguments:
+        opts -- parsed command line options
+        input_files -- OSM pbf files
+    """
+    for input_file in input_files:
+        with OSMtoESHandler(opts) as handler:
+            handler.run(input_file)
+
+
+def import_files_parallel(opts):
+    """
+    Splits the input files among opts.parallel processes, each one
+    importing its share with import_files
+
+    Arguments:
+        opts -- parsed command line options
+
+    Returns:
+        bool -- True if every process finished successfully
+    """
+    processes = []
+    for group in range(min(opts.parallel, len(opts.input_files))):
+        input_files = opts.input_files[group :: opts.parallel]
+        process = multiprocessing.Process(
+            target=import_files,
+            args=(opts, input_files),
+        )
+        processes.append((group, input_files, process))
+        process.start()
+
+    success = True
+    for group, input_files, process in processes:
+        process.join()
+        if process.exitcode != 0:
+            logger.error(
+                f"Import group {group} ({', '.join(input_files)}) "
+                f"failed with exit code {process.exitcode}"
+            )
+            success = False
+
+    return success
+
+
 if __name__ == "__main__":
 
+    # Writers inherit the already imported modules and settings instead of
+    # importing everything again, they open their own ES connections after
+    if sys.platform != "win32":
+        multiprocessing.set_start_method("fork")
+
     # create the parser
     parser = argparse.ArgumentParser(
         description="Imports OSM data into Elasticsearch", usage="python3 %(prog)s"
     )
 
-    parser.add_argument("input_file", help="OSM input PBF file")
+    parser.add_argument(
+        "input_files",
+        nargs="+",
+        help="OSM input PBF files, for example extracts of adjacent regions",
+    )
     parser.add_argument(
         "--index-name",
         action="store",
@@ -52,6 +110,14 @@ if __name__ == "__main__":
         default="changeme",
         help="Elasticsearch password (default: %(default)s)",
     )
+    parser.add_argument(
+        "--es-shards",
+        action="store",
+        dest="es_shards",
+        default=3,
+        type=int,
+        help="Index primary shards (default: %(default)s)",
+    )
     parser.add_argument(
         "--es-replicas",
         action="store",
@@ -69,6 +135,14 @@ if __name__ == "__main__":
         type=int,
         help="Number of worker threads to run (default: %(default)s)",
     )
+    parser.add_argument(
+        "--bulk-requests",
+        action="store",
+        dest="bulk_requests",
+        default=4,
+        type=int,
+        help="Number of concurrent bulk requests per worker (default: %(default)s)",
+    )
     parser.add_argument(
         "--cache-size",
         action="store",
@@ -77,6 +151,55 @@ if __name__ == "__main__":
         type=int,
         help="Number of documents to accumulate before sending to ES (default: %(default)s)",
     )
+    parser.add_argument(
+        "--max-batch-mb",
+        action="store",
+        dest="max_batch_mb",
+        default=10,
+        type=int,
+        help="Maximum size in MB of the documents sent in a single bulk request (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--parallel",
+        action="store",
+        dest="parallel",
+        default=1,
+        type=int,
+        help="Number of input files to import at the same time, each one with its own "
+        "workers. Objects crossing extract borders are repeated, use --osm-ids to "
+        "keep a single copy (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--read-threads",
+        action="store",
+        dest="read_threads",
+        default=None,
+        type=int,
+        help="Number of threads decoding the PBF file (default: libosmium default)",
+    )
+    parser.add_argument(
+        "--nodes-cache-dir",
+        action="store",
+        dest="nodes_cache_dir",
+        default=None,
+        help="Directory for the temporary node locations file used for inputs over 1GB, "
+        "it needs less RAM than the in memory index at the cost of disk IO "
+        "(default: system temporary directory)",
+    )
+    parser.add_argument(
+        "--osm-ids",
+        action="store_true",
+        dest="use_osm_ids",
+        default=False,
+        help="Use the OSM type and id as document id, slower to index but avoids duplicates.",
+    )
+    parser.add_argument(
+        "--keep-tagless-nodes",
+        action="store_true",
+        dest="keep_tagless_nodes",
+        default=False,
+        help="Also index nodes without tags, mostly way vertices.",
+    )
     parser.add_argument(
         "-v",
         action="store_true",
@@ -86,7 +209,7 @@ if __name__ == "__main__":
     )
     opts = parser.parse_args()
 
-    if not opts.input_file:
+    if not opts.input_files:
         parse_fail(parser, "Missing input file")
 
     logging_level = logging.DEBUG if opts.verbose else logging.INFO
@@ -97,9 +220,32 @@ if __name__ == "__main__":
 
     try:
         logger.info("Starting import process")
-        with OSMtoESHandler(opts) as handler:
-            handler.run(opts.input_file)
-            logger.info("Import done")
+
+        try:
+            create_index(opts)
+        except:
+            raise ValueError("Error creating the ES index, check URL and credentials")
+
+        if opts.parallel > 1:
+            if not import_files_parallel(opts):
+                logger.error(
+                    f"Some input files were not fully imported, "
+                    f"index [{opts.index_name}] is left without finalizing"
+                )
+                sys.exit(1)
+        else:
+            import_files(opts, opts.input_files)
+
+        try:
+            finalize_index(opts)
+        except Exception as e:
+            logger.error(
+                f"Error finalizing index [{opts.index_name}], the data is loaded but "
+                f"refresh, translog durability and replicas may not be restored: {e}"
+            )
+            sys.exit(1)
+
+        logger.info("Import done")
     except KeyboardInterrupt:
         logger.warning("Finshing by keyboard")
         sys.exit(-1)
\ No newline at end of file
@@ -1,35 +1,36 @@
-from collections import namedtuple
-from osmium.osm import RelationMember
+def members2dict(members):
+    """
+    Convert osmium relation members into a list of python dicts
 
+    Arguments:
+        members {RelationMemberList} -- osmium members of a relation
 
-def members2dict( members):
-    member_list = []
-    for member in members:
-        if isinstance(member, tuple):
-            m = namedtuple("member", ("type", "ref", "role"))
-        elif isinstance(member, RelationMember):
-            m = member
-        member_list.append({"ref": m.ref, "role": m.role, "type": m.type})
-    return member_list
+    Returns:
+        list -- a dict with ref, role and type for every member
+    """
+    return [{"ref": m.ref, "role": m.role, "type": m.type} for m in members]
 
 
-def tags2dict(tags, type):
+def split_tags(tags, promoted_set):
     """
-    Convert osmium TagList into python dict
+    Split an osmium TagList into promoted and other tags in a single pass
 
     Arguments:
         tags {TagList} -- osmium TagList for a geo-object
+        promoted_set {frozenset} -- keys promoted to their own field
 
     Returns:
-        dict -- tags in a python dict
+        tuple -- promoted tags dict and other tags dict
     """
-    tag_dict = {}
+    promoted = {}
+    other = {}
 
     for tag in tags:
-        if tag.k not in OSM_TAGS[type]:
-            tag_dict[tag.k] = tag.v
+        # Every attribute access builds a new str out of osmium, read it once
+        key = tag.k
+        (promoted if key in promoted_set else other)[key] = tag.v
 
-    return tag_dict
+    return promoted, other
 
 
 OSM_TAGS = {
@@ -82,6 +83,9 @@ OSM_TAGS = {
     "relation": ["name", "man_made", "wikidata"],
 }
 
+# Same promoted tags as frozensets for constant time membership tests
+OSM_TAGS_SET = {type: frozenset(tags) for type, tags in OSM_TAGS.items()}
+
 INDEX_MAPPINGS = {
     "properties": {
         # common